@@ -1,15 +1,19 @@
 import cv2
+import numpy as np
 from roboflow import Roboflow
 import time
 import os
 from dotenv import load_dotenv
 import tempfile
+import queue
+import itertools
 import traceback
 import logging
-from threading import Thread, Lock
+from threading import Thread, Lock, Event, Semaphore
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import TypedDict, Callable
-from pose_statistics import PostureMetrics
-import subprocess
+from pose_statistics import PostureMetrics, PostureWindow
+from pose_classifier import OnnxPostureClassifier
 
 
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +22,40 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+GRAPH_REFRESH_INTERVAL = 10
+WINDOW_NAME = 'Posture Analyzer'
+
+# Cores the pipeline threads are pinned to (Linux only), wrapped around the
+# cores available to the process
+PROCESS_CORES = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+CAPTURE_CORE = 0
+UI_CORE = 1
+# First inference core, each in-flight worker gets the next one
+INFERENCE_CORE = 2
+
+# The Roboflow classification model only accepts a file path, so keep the
+# frames handed to it on tmpfs when available instead of the disk
+FRAME_DIR_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
+JPEG_QUALITY = 75
+# The hosted model resizes its input anyway, so upload a small frame
+HOSTED_INPUT_SIZE = (416, 416)
+
+def pin_current_thread(core_id, niceness=0):
+    # On Linux both the affinity and the niceness apply to the calling thread.
+    # Cores come from the process-wide list read at import, a new thread
+    # inherits the mask of its (possibly pinned) creator
+    if PROCESS_CORES:
+        try:
+            os.sched_setaffinity(0, {PROCESS_CORES[core_id % len(PROCESS_CORES)]})
+        except OSError as e:
+            logger.warning(f"Could not pin thread to core {core_id}: {e}")
+    if niceness:
+        try:
+            os.nice(niceness)
+        except OSError as e:
+            # Raising the priority needs CAP_SYS_NICE
+            logger.debug(f"Could not change thread niceness: {e}")
+
 class PredictionResult(TypedDict):
     class_name: str
     confidence: float
@@ -31,52 +69,148 @@ class PredictionResult(TypedDict):
 
 
 class PoseAnalyzer:
-    def __init__(self, api_key=None):
-        # Initialize Roboflow model
-        rf = Roboflow(api_key=api_key)
-        project = rf.workspace().project("posture_correction_v4")
-        self.model = project.version(1).model
-        
-        # Create a temporary directory for frame processing
-        self.temp_dir = tempfile.mkdtemp()
+    def __init__(self, api_key=None, onnx_model_path=None, class_names=None):
+        # The classification endpoint takes one image per request, so overlap
+        # a couple of requests to hide the network round trip
+        self.max_in_flight = 2
+        # One core per worker, each one preprocesses and runs its own frame
+        worker_cores = itertools.count(INFERENCE_CORE)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                           initializer=lambda: pin_current_thread(next(worker_cores)))
+        self.in_flight = Semaphore(self.max_in_flight)
+
+        self.classifier = None
+        self.model = None
+        self.temp_dir = None
+        self.temp_paths = []
+        if onnx_model_path:
+            # Run the model locally, no network round trip nor frame files.
+            # Split the physical cores (assuming SMT) between in-flight runs
+            num_threads = max(1, (os.cpu_count() or 2) // 2 // self.max_in_flight)
+            self.classifier = OnnxPostureClassifier(onnx_model_path, class_names, num_threads=num_threads)
+        else:
+            # Initialize Roboflow model
+            rf = Roboflow(api_key=api_key)
+            project = rf.workspace().project("posture_correction_v4")
+            self.model = project.version(1).model
+
+            # Create a temporary directory for frame processing
+            self.temp_dir = tempfile.mkdtemp(dir=FRAME_DIR_ROOT)
+            self.temp_paths = [os.path.join(self.temp_dir, f'frame_{i}.jpg')
+                               for i in range(self.max_in_flight)]
+        # Keep the frame files open so each frame is a pwrite, not an open
+        self.free_frame_files = queue.Queue()
+        self.frame_fds = []
+        for temp_path in self.temp_paths:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.frame_fds.append(fd)
+            self.free_frame_files.put((temp_path, fd))
         
         
         self.latest_frame = None
+        self.frame_lock = Lock()
+        self.frame_requested = Event()
+        self.frame_event = Event()
+        self.status_lock = Lock()
         self.current_status = "Initializing..."
         self.running = True
+        self.stop_event = Event()
+        self.camera_lost = Event()
         self.last_prediction_time = 0
+        self.last_result_time = 0
         self.prediction_interval = 0.5
 
-    def prediction_worker(self,cap:cv2.VideoCapture, callback:Callable[[PredictionResult], None]=None):
+    def capture_worker(self, cap:cv2.VideoCapture):
+        # Single reader of the camera. CAP_PROP_BUFFERSIZE is ignored by many
+        # backends, so keep draining the driver queue with grab() and only
+        # decode with retrieve() when a consumer asked for a frame.
+        # Raise its priority so the driver queue never backs up
+        pin_current_thread(CAPTURE_CORE, niceness=-5)
         while self.running:
-            ret, frame = cap.read()
+            if not cap.grab():
+                # Stop the whole pipeline, the display loop reports it
+                logger.error("Failed to read frame from camera")
+                self.camera_lost.set()
+                self.running = False
+                self.stop_event.set()
+                break
+            if not self.frame_requested.is_set():
+                continue
+            self.frame_requested.clear()
+            ret, frame = cap.retrieve()
             if not ret:
+                continue
+            # Published frames are shared by reference with every consumer,
+            # so each one is a fresh array that nobody may write to
+            frame.flags.writeable = False
+            with self.frame_lock:
+                self.latest_frame = frame
+            self.frame_event.set()
+
+    def get_latest_frame(self):
+        self.frame_requested.set()
+        with self.frame_lock:
+            return self.latest_frame
+
+    def prediction_worker(self, callback:Callable[[PredictionResult], None]=None):
+        pin_current_thread(INFERENCE_CORE)
+        while self.running:
+            # Wait out the rest of the interval, woken early when stopping
+            remaining = self.last_prediction_time + self.prediction_interval - time.time()
+            if remaining > 0 and self.stop_event.wait(timeout=remaining):
                 break
-            current_time = time.time()
-            if current_time - self.last_prediction_time >= self.prediction_interval:
-                latest_frame = frame.copy()
-                self.last_prediction_time = current_time
-                try:
-                    status = self.analyze_posture(latest_frame)
-                    self.current_status = status
-                    if callback:
-                        callback(status)
-                except Exception as e:
-                    logger.error(f"Error in prediction worker: {e}")
-            
-            time.sleep(0.5)  # Small sleep to prevent CPU spinning
+            # Bound the number of Roboflow requests in flight
+            if not self.in_flight.acquire(timeout=self.prediction_interval):
+                continue
+            self.frame_event.clear()
+            self.frame_requested.set()
+            if not self.frame_event.wait(timeout=self.prediction_interval):
+                self.in_flight.release()
+                continue
+            self.frame_event.clear()
+            captured_at = time.time()
+            self.last_prediction_time = captured_at
+            future = self.executor.submit(self.analyze_posture, self.get_latest_frame())
+            future.add_done_callback(
+                lambda f, t=captured_at: self.on_prediction_done(f, t, callback))
+
+    def on_prediction_done(self, future:Future, captured_at:float, callback:Callable[[PredictionResult], None]=None):
+        self.in_flight.release()
+        try:
+            status = future.result()
+        except Exception as e:
+            logger.error(f"Error in prediction worker: {e}")
+            return
+        with self.status_lock:
+            # Requests overlap, so drop results older than the last delivered one
+            if captured_at < self.last_result_time:
+                return
+            self.last_result_time = captured_at
+            self.current_status = status
+            if callback:
+                callback(status)
 
     def analyze_posture(self, frame):
-        # Save frame temporarily
-        temp_path = os.path.join(self.temp_dir, 'temp_frame.jpg')
-        cv2.imwrite(temp_path, frame)
-        
-        # Predict using the Roboflow model with file path
-        predictions = self.model.predict(temp_path).json()
-        
-        # Clean up
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        if self.classifier is not None:
+            predicted_class, confidence = self.classifier.predict(frame)
+            logger.info(f'Top prediction: {predicted_class} ({confidence:.2%})')
+            return PredictionResult(class_name=predicted_class, confidence=confidence, timestamp=int(time.time()))
+
+        # Save frame temporarily, each in-flight request owns one frame file
+        temp_path, fd = self.free_frame_files.get()
+        try:
+            small = cv2.resize(frame, HOSTED_INPUT_SIZE, interpolation=cv2.INTER_AREA)
+            ok, buffer = cv2.imencode('.jpg', small, (cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY))
+            if not ok:
+                raise RuntimeError("Failed to encode frame")
+            os.pwrite(fd, buffer, 0)
+            os.ftruncate(fd, len(buffer))
+
+            # Predict using the Roboflow model with file path, the frame is
+            # removed on cleanup
+            predictions = self.model.predict(temp_path).json()
+        finally:
+            self.free_frame_files.put((temp_path, fd))
         
         # Process predictions
         posture_status = self.interpret_predictions(predictions)
@@ -96,96 +230,194 @@ class PoseAnalyzer:
         return PredictionResult(class_name=predicted_class, confidence=confidence, timestamp=int(time.time()))
     
     def cleanup(self):
+        # Wait for in-flight requests before removing their frames
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+        for fd in self.frame_fds:
+            os.close(fd)
+        self.frame_fds = []
+
         # Cleanup temp directory
-        if os.path.exists(self.temp_dir):
+        if self.temp_dir and os.path.exists(self.temp_dir):
+            for temp_path in self.temp_paths:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
             os.rmdir(self.temp_dir)
 
+def start_helper_threads():
+    # Threads inherit the affinity and niceness of the thread that creates
+    # them, so create OpenCV's parallel_for pool and the HighGUI window from
+    # the unpinned main thread before any pipeline thread is pinned.
+    # ONNX Runtime's pool already exists, it is created with the session
+    cv2.namedWindow(WINDOW_NAME)
+    cv2.resize(np.zeros((720, 1280, 3), dtype=np.uint8), HOSTED_INPUT_SIZE, interpolation=cv2.INTER_AREA)
+
 def start_worker(analyzer:PoseAnalyzer, cv2_cap:cv2.VideoCapture, callback:Callable[[PredictionResult], None]):
-    prediction_thread = Thread(target=analyzer.prediction_worker, daemon=True, args=(cv2_cap, callback,))
+    capture_thread = Thread(target=analyzer.capture_worker, daemon=True, args=(cv2_cap,))
+    prediction_thread = Thread(target=analyzer.prediction_worker, daemon=True, args=(callback,))
+    capture_thread.start()
     prediction_thread.start()
-    return prediction_thread            
+    return capture_thread, prediction_thread
 
-def stop_worker(analyzer:PoseAnalyzer, prediction_thread:Thread):
+def stop_worker(analyzer:PoseAnalyzer, worker_threads:tuple[Thread, ...]):
     analyzer.running = False
-    prediction_thread.join(timeout=1.0)
+    analyzer.stop_event.set()
+    for thread in worker_threads:
+        thread.join(timeout=1.0)
  
-def print_video(cv2_cap:cv2.VideoCapture, result:PredictionResult):
-    ret, frame = cv2_cap.read()
-    if not ret:
-        logger.error("Failed to read frame in callback")
-        return
+# Text rasterized once into a mask and stamped onto each frame, it is only
+# rendered again when the text changes
+class TextSprite:
+    def __init__(self, font_scale, thickness, color=(0, 0, 0), font=cv2.FONT_HERSHEY_SIMPLEX):
+        self.font_scale = font_scale
+        self.thickness = thickness
+        self.color = color
+        self.font = font
+        self.text = None
+        self.mask = None
+        self.offset = (0, 0)
+
+    def render(self, text):
+        (width, height), baseline = cv2.getTextSize(text, self.font, self.font_scale, self.thickness)
+        # Some glyphs like '(' overflow the box getTextSize reports, so draw
+        # on a larger canvas and crop to what was actually drawn
+        pad_x = 2 * self.thickness
+        pad_y = height
+        canvas = np.zeros((height + baseline + 2 * pad_y, width + 2 * pad_x), dtype=np.uint8)
+        cv2.putText(canvas, text, (pad_x, height + pad_y), self.font, self.font_scale, 255, self.thickness)
+        x, y, w, h = cv2.boundingRect(canvas)
+        self.mask = canvas[y:y + h, x:x + w].astype(bool)
+        # Offset of the mask from the text origin
+        self.offset = (x - pad_x, y - height - pad_y)
+        self.text = text
+
+    def draw(self, frame, text, org):
+        if text != self.text:
+            self.render(text)
+        # org is the bottom-left corner of the text like in cv2.putText
+        left = org[0] + self.offset[0]
+        top = org[1] + self.offset[1]
+        mask = self.mask[max(0, -top):frame.shape[0] - top, max(0, -left):frame.shape[1] - left]
+        top, left = max(0, top), max(0, left)
+        region = frame[top:top + mask.shape[0], left:left + mask.shape[1]]
+        region[mask] = self.color
+
+status_sprite = TextSprite(1, 2)
+help_sprite = TextSprite(0.6, 1)
+
+# Latest prediction handed from the prediction callbacks to the display loop
+class SharedResult:
+    __slots__ = ('result', 'count', 'lock')
+
+    def __init__(self):
+        self.result = None
+        self.count = 0
+        self.lock = Lock()
+
+def print_video(frame, shared:SharedResult):
+    with shared.lock:
+        result = shared.result
+    # Draw on a copy, the frame is shared with the prediction worker
+    frame = frame.copy()
     message = f"{result['class_name']} ({result['confidence']:.2%})" if result else "No result"
     # Display frame with status
-    cv2.putText(frame, message, (10, 30),
-                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+    status_sprite.draw(frame, message, (10, 30))
 
     # Add instructions for key commands
-    cv2.putText(frame, "Press 'g' for graph, 'q' to quit", (10, frame.shape[0] - 20),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
-
-    cv2.imshow('Posture Analyzer', frame)
+    help_sprite.draw(frame, "Press 'g' for graph, 'q' to quit", (10, frame.shape[0] - 20))
 
-last_pose_result = None
-last_pose_result_number = 0
+    cv2.imshow(WINDOW_NAME, frame)
 
-def worker_callback(postureMetrics:PostureMetrics):
+def worker_callback(postureMetrics:PostureMetrics, shared:SharedResult):
     def collect_result(result:PredictionResult):
-        global last_pose_result
-        last_pose_result = result
-        global last_pose_result_number
-        last_pose_result_number += 1
-        logger.info(f"Callback {last_pose_result_number}: {result}")
+        with shared.lock:
+            shared.result = result
+            shared.count += 1
+            count = shared.count
+        logger.info(f"Callback {count}: {result}")
         if result:
             postureMetrics.add_reading(result['class_name'])
     return collect_result
 
 def real_time_monitor(analyzer:PoseAnalyzer, camera_index=0, fps=60):
-    import matplotlib
-    matplotlib.use('Qt5Agg') 
-
     # Real-time posture monitoring
     cap = cv2.VideoCapture(camera_index)
     cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
     postureMetrics = PostureMetrics()
-    prediction_thread = start_worker(analyzer, cap, worker_callback(postureMetrics))
-
-    logger.info("Posture monitoring started!")
-    logger.info("Press 'g' to show daily graph, 'q' to quit")
-    graph_subprocess = None
-
-    while True:
-        time.sleep(1/fps)
-        print_video(cap, last_pose_result)
-
-        # Handle key presses
-        key = cv2.waitKey(1) & 0xFF
-
-        # Exit on 'q' key
-        if key == ord('q'):
-            break
-        # Show graph on 'g' key
-        elif key == ord('g'):
-            if not graph_subprocess or graph_subprocess.poll() is not None:
-                graph_subprocess = subprocess.Popen(['python', '-m', 'pose_statistics'])
-                logger.info("Graph started!")
-            else:
-                logger.info("Close graph!")
-                graph_subprocess.terminate()
-
-                
-        
+    shared = SharedResult()
+    start_helper_threads()
+    worker_threads = start_worker(analyzer, cap, worker_callback(postureMetrics, shared))
+    graph_window = None
+    try:
+        pin_current_thread(UI_CORE)
+
+        logger.info("Posture monitoring started!")
+        logger.info("Press 'g' to show daily graph, 'q' to quit")
+        last_graph_update = 0
+
+        frame_ms = 1000 // fps
+        while True:
+            loop_start = time.perf_counter()
+            if analyzer.camera_lost.is_set():
+                logger.error("Camera lost, stopping posture monitoring")
+                print("Camera lost, stopping posture monitoring")
+                break
+            frame = analyzer.get_latest_frame()
+            if frame is not None:
+                print_video(frame, shared)
+            postureMetrics.flush_if_due()
+
+            # Keep the graph updated in this process. It stays on the TkAgg
+            # backend set by pose_statistics, a PyQt5 backend would clash
+            # with the Qt bundled in opencv-python. Its events are pumped
+            # from this loop
+            if graph_window is not None:
+                opening = last_graph_update == 0
+                if (opening or graph_window.is_open()) and time.time() - last_graph_update >= GRAPH_REFRESH_INTERVAL:
+                    postureMetrics.flush()
+                    graph_window.plot_daily_summary(hours_back=1)
+                    last_graph_update = time.time()
+                if graph_window.is_open():
+                    graph_window.process_events()
+                else:
+                    # Closed by the user, or nothing to plot yet
+                    graph_window = None
+
+            # Handle key presses, waiting out the rest of the frame budget so
+            # the GUI event loop gets all the idle time
+            elapsed_ms = int((time.perf_counter() - loop_start) * 1000)
+            key = cv2.waitKey(max(1, frame_ms - elapsed_ms)) & 0xFF
+
+            # Exit on 'q' key
+            if key == ord('q'):
+                break
+            # Show graph on 'g' key
+            elif key == ord('g'):
+                if graph_window is None or not graph_window.is_open():
+                    graph_window = PostureWindow(postureMetrics.db_path)
+                    last_graph_update = 0
+                    logger.info("Graph started!")
+                else:
+                    logger.info("Close graph!")
+                    graph_window.close_plot()
+                    graph_window = None
+    finally:
+        # Also runs on Ctrl+C or an error, so buffered readings are written
+        stop_worker(analyzer, worker_threads)
+        cap.release()
+        cv2.destroyAllWindows()
+        if graph_window is not None:
+            graph_window.close_plot()
+        analyzer.cleanup()
+        postureMetrics.close()
 
-    stop_worker(analyzer, prediction_thread)
-    cap.release()
-    cv2.destroyAllWindows()
-    if graph_subprocess:
-        graph_subprocess.terminate()
-    analyzer.cleanup()
-    
 
 def main():
     try:
-        analyzer = PoseAnalyzer(api_key=os.getenv('ROBOFLOW_API_KEY'))
+        class_names = os.getenv('POSE_CLASS_NAMES')
+        analyzer = PoseAnalyzer(api_key=os.getenv('ROBOFLOW_API_KEY'),
+                                onnx_model_path=os.getenv('POSE_ONNX_MODEL'),
+                                class_names=class_names.split(',') if class_names else None)
         real_time_monitor(analyzer)
     except ValueError as e:
         logger.error(f"Error: {e}\n{traceback.format_exc()}")
@@ -0,0 +1,195 @@
+import argparse
+import ast
+import glob
+import logging
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+logger = logging.getLogger(__name__)
+
+# Used in this order when available, CUDA falls back to CPU
+DEFAULT_PROVIDERS = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+# Input size used when the model has dynamic spatial dimensions
+DEFAULT_INPUT_SIZE = 224
+
+
+def preprocess_frame(frame, input_size, resized=None, blob=None):
+    # Resize, BGR->RGB, HWC->NCHW and scale to [0, 1], writing into the
+    # given buffers when provided so nothing is allocated per frame
+    width, height = input_size
+    if resized is None:
+        resized = np.empty((height, width, 3), dtype=np.uint8)
+    if blob is None:
+        blob = np.empty((1, 3, height, width), dtype=np.float32)
+    cv2.resize(frame, input_size, dst=resized, interpolation=cv2.INTER_AREA)
+    np.multiply(resized[:, :, ::-1].transpose(2, 0, 1), np.float32(1 / 255), out=blob[0])
+    return blob
+
+
+def model_input_size(session):
+    # Input is NCHW, return (width, height) for cv2.resize
+    _, _, height, width = session.get_inputs()[0].shape
+    return (width if isinstance(width, int) else DEFAULT_INPUT_SIZE,
+            height if isinstance(height, int) else DEFAULT_INPUT_SIZE)
+
+
+# Runs the posture classification model locally with ONNX Runtime
+class OnnxPostureClassifier:
+    def __init__(self, model_path, class_names=None, providers=None, num_threads=None):
+        if ort is None:
+            raise ImportError("onnxruntime is required to run a local model, install it with 'pip install onnxruntime'")
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        available = ort.get_available_providers()
+        providers = providers or [p for p in DEFAULT_PROVIDERS if p in available]
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=providers)
+        logger.info(f"Loaded {model_path} with providers {self.session.get_providers()}")
+
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_size = model_input_size(self.session)
+
+        self.class_names = list(class_names) if class_names else self.read_class_names()
+
+        model_output = self.session.get_outputs()[0]
+        self.output_name = model_output.name
+        # Batch of one, a dynamic class dimension has one score per class name
+        self.output_shape = tuple([1] + [d if isinstance(d, int) else len(self.class_names)
+                                         for d in model_output.shape[1:]])
+
+        # Input and output buffers are fixed for the session, each inference
+        # thread gets its own set bound once through an IOBinding, so one
+        # thread preprocesses the next frame while the other one runs
+        self.thread_buffers = threading.local()
+        self.on_cuda = self.session.get_providers()[0] == 'CUDAExecutionProvider'
+
+    def read_class_names(self):
+        # Exported classification models usually carry a {index: name} dict
+        names = self.session.get_modelmeta().custom_metadata_map.get('names')
+        if names is None:
+            raise ValueError("Class names not found in the model metadata, pass them explicitly")
+        names = ast.literal_eval(names)
+        if isinstance(names, dict):
+            return [names[i] for i in sorted(names)]
+        return list(names)
+
+    def buffers(self):
+        buffers = self.thread_buffers
+        if not hasattr(buffers, 'binding'):
+            width, height = self.input_size
+            buffers.resized = np.empty((height, width, 3), dtype=np.uint8)
+            buffers.blob = np.empty((1, 3, height, width), dtype=np.float32)
+            buffers.binding = self.session.io_binding()
+            if self.on_cuda:
+                # Keep input and output on the GPU, the blob is copied in
+                # before each run and the scores only copied back when read
+                buffers.input_value = ort.OrtValue.ortvalue_from_shape_and_type(buffers.blob.shape, np.float32, 'cuda', 0)
+                buffers.output_value = ort.OrtValue.ortvalue_from_shape_and_type(self.output_shape, np.float32, 'cuda', 0)
+            else:
+                # CPU OrtValues share the NumPy memory, so filling the blob in
+                # place is enough for the next run
+                buffers.output = np.empty(self.output_shape, dtype=np.float32)
+                buffers.input_value = ort.OrtValue.ortvalue_from_numpy(buffers.blob)
+                buffers.output_value = ort.OrtValue.ortvalue_from_numpy(buffers.output)
+            buffers.binding.bind_ortvalue_input(self.input_name, buffers.input_value)
+            buffers.binding.bind_ortvalue_output(self.output_name, buffers.output_value)
+        return buffers
+
+    def predict(self, frame):
+        buffers = self.buffers()
+        preprocess_frame(frame, self.input_size, buffers.resized, buffers.blob)
+        if self.on_cuda:
+            buffers.input_value.update_inplace(buffers.blob)
+        self.session.run_with_iobinding(buffers.binding)
+        scores = (buffers.output_value.numpy() if self.on_cuda else buffers.output).reshape(-1)
+        # Some exports return logits instead of probabilities
+        if scores.min() < 0 or not np.isclose(scores.sum(), 1.0, atol=1e-3):
+            exp = np.exp(scores - scores.max())
+            scores = exp / exp.sum()
+        index = int(np.argmax(scores))
+        return self.class_names[index], float(scores[index])
+
+
+# Feeds saved webcam frames to the static quantization calibration
+class FrameCalibrationReader:
+    def __init__(self, frames_dir, input_name, input_size):
+        self.paths = sorted(glob.glob(os.path.join(frames_dir, '*.jpg')))
+        if not self.paths:
+            raise ValueError(f"No calibration frames (*.jpg) found in {frames_dir}")
+        self.input_name = input_name
+        self.input_size = input_size
+        self.rewind()
+
+    def get_next(self):
+        path = next(self.iterator, None)
+        if path is None:
+            return None
+        return {self.input_name: preprocess_frame(cv2.imread(path), self.input_size)}
+
+    def rewind(self):
+        self.iterator = iter(self.paths)
+
+
+def save_calibration_frames(frames_dir, camera_index=0, count=50, interval=0.2):
+    os.makedirs(frames_dir, exist_ok=True)
+    cap = cv2.VideoCapture(camera_index)
+    try:
+        for i in range(count):
+            ret, frame = cap.read()
+            if not ret:
+                raise RuntimeError("Failed to read frame from camera")
+            cv2.imwrite(os.path.join(frames_dir, f'frame_{i:03d}.jpg'), frame)
+            time.sleep(interval)
+    finally:
+        cap.release()
+    logger.info(f"Saved {count} calibration frames to {frames_dir}")
+
+
+def quantize_model(model_path, frames_dir, output_path):
+    # INT8 weights and UINT8 activations in QDQ format, the layout ONNX
+    # Runtime maps to VNNI on x86 and to INT8 kernels on the TensorRT/CUDA EPs
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    reader = FrameCalibrationReader(frames_dir, session.get_inputs()[0].name, model_input_size(session))
+    quantize_static(model_path, output_path, reader,
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=True)
+    logger.info(f"Saved INT8 model to {output_path}")
+
+
+# Prepares an INT8 version of the local model:
+#   python -m pose_classifier frames calibration_frames
+#   python -m pose_classifier quantize model.onnx calibration_frames model.int8.onnx
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Prepare an INT8 posture classifier")
+    commands = parser.add_subparsers(dest='command', required=True)
+    frames_parser = commands.add_parser('frames', help="save webcam frames for calibration")
+    frames_parser.add_argument('frames_dir')
+    frames_parser.add_argument('--camera', type=int, default=0)
+    frames_parser.add_argument('--count', type=int, default=50)
+    quantize_parser = commands.add_parser('quantize', help="quantize a model with the saved frames")
+    quantize_parser.add_argument('model_path')
+    quantize_parser.add_argument('frames_dir')
+    quantize_parser.add_argument('output_path')
+    args = parser.parse_args()
+
+    if args.command == 'frames':
+        save_calibration_frames(args.frames_dir, camera_index=args.camera, count=args.count)
+    else:
+        if ort is None:
+            raise ImportError("onnxruntime is required to quantize the model, install it with 'pip install onnxruntime'")
+        quantize_model(args.model_path, args.frames_dir, args.output_path)
@@ -3,59 +3,156 @@ import matplotlib
 matplotlib.use('TkAgg')  # Use Tkinter backend for GUI window on Ubuntu
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import numpy as np
 from datetime import datetime, timedelta
 from collections import deque
 import time
 import logging
+from threading import Lock
 
 # Set up basic logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Readings are stored in naive local time, minutes are counted from this
+# naive epoch so that plotting them gives back local wall-clock times
+EPOCH = datetime(1970, 1, 1)
+
+
+def minute_of(timestamp):
+    return (timestamp - EPOCH) // timedelta(minutes=1)
+
+
+def init_db(conn):
+    # Shared by the monitor and the standalone graph, either may open the
+    # database first. Runs in one transaction so the rollup is backfilled once
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS posture_readings (
+                timestamp DATETIME,
+                status TEXT,
+                is_good INTEGER
+            )
+        ''')
+        # Nothing queries the raw readings by time since the graph reads the
+        # rollup, drop the index older databases have
+        conn.execute('DROP INDEX IF EXISTS idx_ts')
+
+        # Per-minute rollup the graph reads instead of every reading,
+        # backfilled from the existing readings when first created
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posture_minutely'"
+        ).fetchone()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS posture_minutely (
+                ts INTEGER PRIMARY KEY,
+                good INTEGER,
+                total INTEGER
+            )
+        ''')
+        if not exists:
+            conn.execute('''
+                INSERT INTO posture_minutely (ts, good, total)
+                SELECT CAST(strftime('%s', timestamp) AS INTEGER) / 60, SUM(is_good), COUNT(*)
+                FROM posture_readings
+                GROUP BY 1
+            ''')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
 
 
 class PostureMetrics:
-    def __init__(self, db_path="posture_data.db", window_size=30):
+    def __init__(self, db_path="posture_data.db", window_size=30, flush_size=10, flush_interval=5):
         self.db_path = db_path
         self.window_size = window_size
         self.recent_readings = deque(maxlen=window_size)
+        self.good_count = 0  # Running sum of recent_readings
         self.fig = None
         self.ax = None
         self.last_alert_time = 0  # Track last alert timestamp
+
+        # Readings are buffered and written in one transaction every
+        # flush_size readings or flush_interval seconds
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending_readings = []
+        self.last_flush_time = time.time()
+
+        # Single connection shared with the prediction threads, autocommit
+        # mode so transactions are explicit
+        self.db_lock = Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
         self.init_db()
     
     def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS posture_readings (
-                timestamp DATETIME,
-                status TEXT,
-                is_good INTEGER
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        init_db(self.conn)
     
     def add_reading(self, status):
         is_good = 1 if status == "looks good" else 0
         timestamp = datetime.now()
         
         # Salvar no banco
-        conn = sqlite3.connect(self.db_path)
-        conn.execute(
-            "INSERT INTO posture_readings VALUES (?, ?, ?)",
-            (timestamp, status, is_good)
-        )
-        conn.commit()
-        conn.close()
+        with self.db_lock:
+            self.pending_readings.append((timestamp, status, is_good))
+            if (len(self.pending_readings) >= self.flush_size
+                    or time.time() - self.last_flush_time >= self.flush_interval):
+                self.write_pending_readings()
         
+        # The deque drops its oldest reading when full, keep the count in sync
+        if len(self.recent_readings) == self.window_size:
+            self.good_count -= self.recent_readings[0]
         self.recent_readings.append(is_good)
+        self.good_count += is_good
         
         # Verificar se precisa alertar
         if len(self.recent_readings) >= self.window_size//2:
-            good_readings = sum(self.recent_readings)
-            if good_readings < self.window_size // 2:
+            if self.good_count < self.window_size // 2:
                 self.trigger_alert()
+
+    def write_pending_readings(self):
+        # Must be called with db_lock held
+        self.last_flush_time = time.time()
+        if not self.pending_readings:
+            return
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany(
+                "INSERT INTO posture_readings VALUES (?, ?, ?)",
+                self.pending_readings
+            )
+            self.conn.executemany(
+                '''INSERT INTO posture_minutely (ts, good, total) VALUES (?, ?, 1)
+                   ON CONFLICT (ts) DO UPDATE SET good = good + excluded.good, total = total + 1''',
+                [(minute_of(timestamp), is_good) for timestamp, _, is_good in self.pending_readings]
+            )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.pending_readings = []
+
+    def flush(self):
+        with self.db_lock:
+            self.write_pending_readings()
+
+    def flush_if_due(self):
+        # Called periodically so readings don't wait for the next one to be
+        # written when the predictions stop
+        with self.db_lock:
+            if self.pending_readings and time.time() - self.last_flush_time >= self.flush_interval:
+                self.write_pending_readings()
+
+    def close(self):
+        with self.db_lock:
+            self.write_pending_readings()
+            self.conn.close()
     
     def trigger_alert(self):
         current_time = time.time()
@@ -83,14 +180,23 @@ class PostureWindow:
         self.db_path = db_path
         self.fig = None
         self.ax = None
+        self.line = None
+        self.background = None
+        self.hours_back = None
+        self.db_ready = False
 
     def plot_daily_summary(self, hours_back=1):
         start_date = datetime.now() - timedelta(hours=hours_back)
 
         conn = sqlite3.connect(self.db_path)
+        if not self.db_ready:
+            # The database may predate the rollup table, or the monitor may
+            # never have run
+            init_db(conn)
+            self.db_ready = True
         cursor = conn.execute(
-            "SELECT timestamp, is_good FROM posture_readings WHERE timestamp > ?",
-            (start_date,)
+            "SELECT ts, good, total FROM posture_minutely WHERE ts >= ? ORDER BY ts",
+            (minute_of(start_date),)
         )
         data = cursor.fetchall()
         conn.close()
@@ -99,51 +205,75 @@ class PostureWindow:
             print("Nenhum dado encontrado")
             return
 
-        timestamps = [datetime.fromisoformat(row[0]) for row in data]
-        values = [row[1] for row in data]
+        # One point per minute with the share of good readings
+        rows = np.array(data, dtype=np.int64)
+        timestamps = (rows[:, 0] * 60).astype('datetime64[s]')
+        values = rows[:, 1] / rows[:, 2]
 
-        # Create figure if it doesn't exist, otherwise clear it
-        if self.fig is None or not plt.fignum_exists(self.fig.number):
+        # Create figure if it doesn't exist
+        if not self.is_open():
             plt.ion()  # Turn on interactive mode first
             self.fig, self.ax = plt.subplots(figsize=(12, 4))
+            self.setup_axes()
+            self.hours_back = None
 
-            # Set up close event handler
+            # Set up close event handler, callers notice it through is_open()
+            # since the window can live inside the monitor process
             def on_close(event):
-                print("\nWindow closed by user. Stopping posture monitoring...")
-                plt.close('all')
-                import sys
-                sys.exit(0)
+                logger.info("Graph window closed by user")
 
             self.fig.canvas.mpl_connect('close_event', on_close)
+            self.fig.canvas.mpl_connect('draw_event', self.on_draw)
 
             # Make the window appear and be interactive
             self.fig.show()
             # Give the GUI time to initialize
             plt.pause(0.1)
-        else:
-            self.ax.clear()
-        
+
         # Plot the data
-        self.ax.plot(timestamps, values, 'b-', linewidth=1, marker='o', markersize=3)
+        self.line.set_data(timestamps, values)
+
+        # Only redraw the whole figure when the time window moved past the
+        # right edge, otherwise blit the line over the cached background
+        now = datetime.now()
+        if hours_back != self.hours_back or mdates.date2num(now) > self.ax.get_xlim()[1]:
+            self.hours_back = hours_back
+            self.ax.set_xlim(start_date, now + timedelta(hours=hours_back) * 0.1)
+            self.ax.set_title(f'Monitoramento de Postura - Últimas {hours_back} horas(s)')
+            self.fig.tight_layout()
+            self.fig.canvas.draw()
+        else:
+            self.fig.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.fig.canvas.blit(self.ax.bbox)
+        self.fig.canvas.flush_events()
+
+    def setup_axes(self):
+        # The line is animated so it is left out of full redraws (and doesn't
+        # mark the figure stale), it is drawn by blitting instead
+        self.line, = self.ax.plot([], [], 'b-', linewidth=1, marker='o', markersize=3, animated=True)
         self.ax.set_ylim(-0.1, 1.1)
-        self.ax.set_ylabel('Postura (1=Boa, 0=Ruim)')
+        self.ax.set_ylabel('Postura boa por minuto (1=Boa, 0=Ruim)')
         self.ax.set_xlabel('Tempo')
-        self.ax.set_title(f'Monitoramento de Postura - Últimas {hours_back} horas(s)')
         self.ax.grid(True, alpha=0.3)
 
         # Format x-axis
+        self.ax.xaxis_date()
         self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
         self.ax.xaxis.set_major_locator(mdates.MinuteLocator(interval=2))
-        plt.setp(self.ax.get_xticklabels(), rotation=45)
+        self.ax.tick_params(axis='x', labelrotation=45)
 
-        self.fig.tight_layout()
+    def on_draw(self, event):
+        # Cache the background of every full redraw and put the line back on top
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
 
-        # Draw and update the figure with proper event handling
-        self.fig.canvas.draw()
-        self.fig.canvas.flush_events()
+    def is_open(self):
+        return self.fig is not None and plt.fignum_exists(self.fig.number)
 
-        # Allow time for user interactions
-        plt.pause(0.1)
+    def process_events(self):
+        if self.is_open():
+            self.fig.canvas.flush_events()
 
     def close_plot(self):
         plt.close('all')
@@ -162,7 +292,7 @@ if __name__ == "__main__":
                 plt.pause(0.001)  # Allow GUI events to be processed
 
                 # Check again if window still exists during sleep
-                if postureMetrics.fig is None or not plt.fignum_exists(postureMetrics.fig.number):
+                if not postureMetrics.is_open():
                     print("\nWindow was closed. Stopping posture monitoring...")
                     running = False
                     break